@@ -1,17 +1,101 @@
 import cv2
+import json
 import numpy as np
 import os
+import re
+import threading
 import time
-from watchdog.observers import Observer
+from concurrent.futures import ThreadPoolExecutor
+# The inotify backend is required: events arrive from the kernel watch, and
+# the close-write events the handler relies on only exist there. Failing the
+# import on non-Linux platforms is deliberate — a fallback observer would
+# never deliver on_closed and the watcher would silently do nothing.
+from watchdog.observers.inotify import InotifyObserver as Observer
 from watchdog.events import FileSystemEventHandler
 
 # Define valid image extensions
 IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".tif"}
 
+# Set DEBUG_VIEW=1 to pop up the debug windows (blocks on a keypress per image)
+DEBUG_VIEW = os.environ.get("DEBUG_VIEW") == "1"
+
+# Set DEBUG_WRITE=1 to keep a copy of the thresholded mask on disk
+DEBUG_WRITE = os.environ.get("DEBUG_WRITE") == "1"
+
 # Global counters for image and text files
 image_counter = 0
 text_counter = 0
 
+# Counter checkpoint kept next to the images so numbering survives restarts
+COUNTER_FILE = ".counters"
+
+# Paths this process creates itself (rename destinations and result files);
+# the filesystem events they generate are echoes to be consumed, not new
+# arrivals to pick up. Guarded by a lock since workers write files too.
+self_paths = set()
+self_paths_lock = threading.Lock()
+
+def claim_path(path):
+    """Records a path this process is about to create, so the event it generates is skipped."""
+    with self_paths_lock:
+        self_paths.add(path)
+
+def consume_self_path(path):
+    """Returns True (and forgets the path) if an event for it is our own echo."""
+    with self_paths_lock:
+        if path in self_paths:
+            self_paths.discard(path)
+            return True
+    return False
+
+# Workers that run process_image off the watchdog dispatcher thread; OpenCV
+# releases the GIL for its heavy calls, so images process in parallel
+EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# Guards the filename counters against concurrent events
+counter_lock = threading.Lock()
+
+def init_counters(folder):
+    """
+    Scans the folder once and continues numbering from the highest existing
+    image_<number> file, so renames after a restart do not collide with files
+    already on disk. The .counters checkpoint is folded in with max(): a crash
+    between a rename and its checkpoint write leaves the checkpoint one
+    behind the files, so the scan is authoritative and the checkpoint can
+    only raise the starting point, never lower it. Runs once at startup;
+    after it the handlers just increment the counters, never rescanning.
+    """
+    global image_counter, text_counter
+    saved_image = saved_text = 0
+    try:
+        with open(os.path.join(folder, COUNTER_FILE)) as f:
+            saved = json.load(f)
+        saved_image = saved["image_counter"]
+        saved_text = saved["text_counter"]
+    except (OSError, ValueError, KeyError):
+        pass
+    highest = 0
+    for entry in os.scandir(folder):
+        name, ext = os.path.splitext(entry.name)
+        if name.startswith("image_") and name[6:].isdigit() and ext.lower() in IMAGE_EXTENSIONS:
+            highest = max(highest, int(name[6:]))
+    image_counter = max(saved_image, highest)
+    text_counter = max(saved_text, highest)
+
+def save_counters(folder):
+    """
+    Checkpoints the counters to .counters, written to a temp file, fsynced
+    and swapped in with os.replace so the checkpoint is always either the
+    old or the new value, never a torn write.
+    """
+    counter_path = os.path.join(folder, COUNTER_FILE)
+    tmp_path = counter_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"image_counter": image_counter, "text_counter": text_counter}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, counter_path)
+
 def get_new_filename(original_path):
     """
     Returns a new file name based on the file type.
@@ -24,113 +108,147 @@ def get_new_filename(original_path):
     name, ext = os.path.splitext(original_name)
     ext_lower = ext.lower()
 
-    if ext_lower in IMAGE_EXTENSIONS:
-        image_counter += 1
-        new_filename = f"image_{image_counter}{ext_lower}"
-    elif ext_lower == ".txt":
-        new_filename = f"coords_{image_counter}.txt"
-    else:
-        # For other file types, keep the original file name
-        new_filename = original_name
+    with counter_lock:
+        if ext_lower in IMAGE_EXTENSIONS:
+            image_counter += 1
+            new_filename = f"image_{image_counter}{ext_lower}"
+        elif ext_lower == ".txt":
+            new_filename = f"coords_{image_counter}.txt"
+        else:
+            # For other file types, keep the original file name
+            new_filename = original_name
 
     return os.path.join(directory, new_filename)
 
 # Define a handler for new files in the folder
 class ImageHandler(FileSystemEventHandler):
-    def on_created(self, event):
-        # Only process files (ignore directories)
-        if not event.is_directory:
-            # Wait briefly to ensure the file is fully written
-            time.sleep(0.5)
-            new_filepath = get_new_filename(event.src_path)
+    """
+    Picks up files the moment their writer closes them. on_closed maps to
+    inotify's IN_CLOSE_WRITE, which fires exactly when the producer finishes,
+    so no wait or size polling is needed; on_moved covers files that are
+    renamed into the folder and were therefore already fully written.
+    """
+
+    def on_closed(self, event):
+        if not event.is_directory and not consume_self_path(event.src_path):
+            self.handle_file(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory and not consume_self_path(event.dest_path):
+            self.handle_file(event.dest_path)
+
+    def handle_file(self, src_path):
+        # Hidden files such as the counter checkpoint are not ours to rename
+        if os.path.basename(src_path).startswith("."):
+            return
+        new_filepath = get_new_filename(src_path)
+        if new_filepath != src_path:
+            # Never rename over a file that already exists — os.rename would
+            # replace it silently and destroy its contents
+            if os.path.exists(new_filepath):
+                print(f"Error: Not renaming '{src_path}': '{new_filepath}' already exists")
+                return
+            # Claim the destination before renaming so the move event our
+            # own os.rename produces is recognized as an echo
+            claim_path(new_filepath)
             try:
-                os.rename(event.src_path, new_filepath)
-                print(f"Renamed '{event.src_path}' to '{new_filepath}'")
+                os.rename(src_path, new_filepath)
+                print(f"Renamed '{src_path}' to '{new_filepath}'")
             except Exception as e:
-                print(f"Error renaming file {event.src_path}: {e}")
+                consume_self_path(new_filepath)
+                print(f"Error renaming file {src_path}: {e}")
                 return
+            save_counters(os.path.dirname(new_filepath))
 
-            # If the file is an image, process it; ignore text files or others
-            _, ext = os.path.splitext(new_filepath)
-            if ext.lower() in IMAGE_EXTENSIONS:
-                process_image(new_filepath)
-            else:
-                print(f"Ignoring non-image file: {new_filepath}")
+        # If the file is an image, hand it to the worker pool so the
+        # watcher thread is free to dispatch the next event
+        _, ext = os.path.splitext(new_filepath)
+        if ext.lower() in IMAGE_EXTENSIONS:
+            EXECUTOR.submit(process_image, new_filepath)
+        else:
+            print(f"Ignoring non-image file: {new_filepath}")
 
 def process_image(filepath):
-    # Check if file exists and is readable
-    if not os.path.exists(filepath):
-        print(f"Error: File does not exist: {filepath}")
-        return
-
-    if not os.access(filepath, os.R_OK):
-        print(f"Error: File is not readable: {filepath}")
-        return
-
     try:
-        # Debug: File size and modification time
-        file_size = os.path.getsize(filepath)
-        file_time = os.path.getmtime(filepath)
-        print(f"File size: {file_size} bytes")
-        print(f"Last modified: {time.ctime(file_time)}")
+        # Debug: file size and modification time from a single stat
+        if DEBUG_VIEW:
+            st = os.stat(filepath)
+            print(f"File size: {st.st_size} bytes")
+            print(f"Last modified: {time.ctime(st.st_mtime)}")
 
-        # Read the image in grayscale
+        # Read the file once and decode in grayscale from memory. A missing or
+        # unreadable file surfaces from this single open, replacing the
+        # separate exists/access pre-checks (two extra syscalls, and racy
+        # anyway since the file could vanish between check and read).
         print(f"Attempting to read image: {filepath}")
-        image = cv2.imread(filepath, cv2.IMREAD_GRAYSCALE)
+        try:
+            with open(filepath, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            print(f"Error: Could not read file {filepath}: {e}")
+            return
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
         if image is None:
-            print(f"Error: OpenCV failed to read image {filepath}")
+            print(f"Error: OpenCV failed to decode image {filepath}")
             return
 
         print(f"Successfully read image. Shape: {image.shape}")
 
-        # Thresholding to create a binary image (black and white)
-        ret, thresh = cv2.threshold(image, 50, 255, cv2.THRESH_BINARY_INV)
+        # Thresholding to create a binary image (black and white).
+        # Otsu picks the level from the histogram in the same pass, so the
+        # result no longer depends on a magic constant tuned for one lighting.
+        ret, thresh = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
 
-        # Save the thresholded (black and white) image copy
-        base_name, ext = os.path.splitext(os.path.basename(filepath))
-        bw_filename = os.path.join(os.path.dirname(filepath), f"{base_name}_bw{ext}")
-        cv2.imwrite(bw_filename, thresh)
-        print(f"Black and white image saved as {bw_filename}")
+        # Save the thresholded (black and white) image copy when debugging.
+        # Nothing downstream reads it, and PBM skips the zlib compression a
+        # PNG of the mask would pay.
+        if DEBUG_WRITE:
+            base_name, ext = os.path.splitext(os.path.basename(filepath))
+            bw_filename = os.path.join(os.path.dirname(filepath), f"{base_name}_bw.pbm")
+            claim_path(bw_filename)
+            cv2.imwrite(bw_filename, thresh, [cv2.IMWRITE_PXM_BINARY, 1])
+            print(f"Black and white image saved as {bw_filename}")
 
         # Zero out the border pixels to prevent edge detection on the image border
-        thresh[0, :] = 0
-        thresh[-1, :] = 0
-        thresh[:, 0] = 0
-        thresh[:, -1] = 0
+        # (one OpenCV call instead of four separate NumPy slice writes)
+        h, w = thresh.shape
+        cv2.rectangle(thresh, (0, 0), (w - 1, h - 1), 0, 1)
 
-        # Find external contours
-        contours, hierarchy = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # Label connected components; areas, bounding boxes and centroids all
+        # come back from this single OpenCV pass, replacing findContours plus
+        # the per-contour arcLength/approxPolyDP loop
+        num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(thresh, 8, cv2.CV_32S)
 
-        # Display the edged image for debugging
-        edged = cv2.Canny(image, 30, 200)
-        cv2.imshow('edged', edged)
-        cv2.waitKey(0)
+        # Display the edged image for debugging (the Canny pass exists only
+        # to feed this window, so skip it entirely when not viewing)
+        if DEBUG_VIEW:
+            edged = cv2.Canny(image, 30, 200)
+            cv2.imshow('edged', edged)
+            cv2.waitKey(0)
 
-        # Convert grayscale image to BGR so we can draw colored contours and centers
-        image_color = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+            # Convert grayscale image to BGR so we can draw colored boxes and centers
+            image_color = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
         rectangle_centers = []
 
-        # Process each contour to check if it is a rectangle and compute its center
-        for cnt in contours:
-            # Approximate contour to polygon
-            epsilon = 0.02 * cv2.arcLength(cnt, True)
-            approx = cv2.approxPolyDP(cnt, epsilon, True)
-
-            # If the polygon has 4 vertices, consider it as a rectangle
-            if len(approx) == 4:
-                M = cv2.moments(cnt)
-                if M["m00"] == 0:
-                    continue
-                cX = int(M["m10"] / M["m00"])
-                cY = int(M["m01"] / M["m00"])
+        # A component whose pixel area nearly fills its bounding box is a rectangle
+        for i in range(1, num_labels):  # label 0 is the background
+            area = stats[i, cv2.CC_STAT_AREA]
+            box_w = stats[i, cv2.CC_STAT_WIDTH]
+            box_h = stats[i, cv2.CC_STAT_HEIGHT]
+            if abs(area - box_w * box_h) / (box_w * box_h) < 0.1:
+                cX, cY = map(int, centroids[i])
                 rectangle_centers.append((cX, cY))
-                # Draw the rectangle and its center on the image
-                cv2.drawContours(image_color, [cnt], -1, (0, 255, 0), 3)
-                cv2.circle(image_color, (cX, cY), 5, (0, 0, 255), -1)
+                if DEBUG_VIEW:
+                    # Draw the bounding box and its center on the image
+                    x = stats[i, cv2.CC_STAT_LEFT]
+                    y = stats[i, cv2.CC_STAT_TOP]
+                    cv2.rectangle(image_color, (x, y), (x + box_w - 1, y + box_h - 1), (0, 255, 0), 3)
+                    cv2.circle(image_color, (cX, cY), 5, (0, 0, 255), -1)
 
-        cv2.imshow('rectangles', image_color)
-        cv2.waitKey(0)
-        cv2.destroyAllWindows()
+        if DEBUG_VIEW:
+            cv2.imshow('rectangles', image_color)
+            cv2.waitKey(0)
+            cv2.destroyAllWindows()
 
         if not rectangle_centers:
             print(f"No rectangles found in {filepath}")
@@ -138,13 +256,21 @@ def process_image(filepath):
 
         print("Detected rectangle centers:", rectangle_centers)
 
-        # Save the coordinates to a text file based on the image file name
+        # Save the coordinates under the image's own number (image_<n> ->
+        # coords_<n>.txt), so the pairing never depends on the live counter
+        # and the rename round-trip through the watcher is skipped entirely
         name_without_ext = os.path.splitext(os.path.basename(filepath))[0]
-        txt_filename = os.path.join(os.path.dirname(filepath), f"{name_without_ext}_coords.txt")
+        number = re.fullmatch(r"image_(\d+)", name_without_ext)
+        if number:
+            txt_filename = os.path.join(os.path.dirname(filepath), f"coords_{number.group(1)}.txt")
+        else:
+            txt_filename = os.path.join(os.path.dirname(filepath), f"{name_without_ext}_coords.txt")
 
+        # Build the whole file contents once and write in a single call;
+        # claim the path first so the watcher ignores our own write event
+        claim_path(txt_filename)
         with open(txt_filename, "w") as f:
-            for center in rectangle_centers:
-                f.write(f"{center[0]}, {center[1]}\n")
+            f.write("".join(f"{x}, {y}\n" for x, y in rectangle_centers))
         print(f"Coordinates saved to {txt_filename}")
 
     except Exception as e:
@@ -164,6 +290,9 @@ if __name__ == "__main__":
     print(f"Folder exists: {os.path.exists(folder_to_watch)}")
     print(f"Folder is readable: {os.access(folder_to_watch, os.R_OK)}")
 
+    # Continue numbering from files already in the folder (single scan)
+    init_counters(folder_to_watch)
+
     # Set up the observer and event handler
     event_handler = ImageHandler()
     observer = Observer()
@@ -171,9 +300,8 @@ if __name__ == "__main__":
 
     observer.start()
     try:
-        # Keep the script running
-        while True:
-            time.sleep(1)
+        # Block on the observer thread instead of waking up every second
+        observer.join()
     except KeyboardInterrupt:
         observer.stop()
-    observer.join()
+        observer.join()
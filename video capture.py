@@ -1,6 +1,38 @@
 import cv2
+import numpy as np
 import os
-import datetime
+import queue
+import sys
+import threading
+import time
+
+# Set NO_PREVIEW=1 to skip the live preview window; commands then come from
+# stdin ('p' + Enter / 'q' + Enter) since cv2.waitKey needs a window to
+# receive keystrokes.
+PREVIEW = os.environ.get("NO_PREVIEW") != "1"
+
+
+def image_writer(write_queue):
+    """
+    Encodes and writes queued (filename, frame) pairs on a worker thread so a
+    capture keypress never stalls the camera loop. A None item shuts it down.
+    """
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+        filename, frame = item
+        cv2.imwrite(filename, frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        print(f"Image saved as: {filename}")
+
+
+def command_reader(command_queue):
+    """
+    Feeds lines typed on stdin to the capture loop when the preview window
+    is disabled and cv2.waitKey therefore cannot see the keyboard.
+    """
+    for line in sys.stdin:
+        command_queue.put(line.strip().lower())
 
 
 def main():
@@ -16,37 +48,76 @@ def main():
         print("Error: Could not open camera.")
         return
 
-    print("Press 'p' to capture an image, or 'q' to quit.")
+    # Preallocate a single frame buffer; retrieve() decodes into it in place,
+    # so the loop stops allocating and freeing a multi-MB array per frame
+    frame_w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    frame_h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    frame_buf = np.empty((frame_h, frame_w, 3), np.uint8)
 
-    while True:
-        # Capture frame-by-frame
-        ret, frame = cap.read()
-        if not ret:
-            print("Failed to grab frame. Exiting...")
-            break
+    # Bounded queue feeding the writer thread; capture only pays a memcpy
+    write_queue = queue.Queue(maxsize=8)
+    writer = threading.Thread(target=image_writer, args=(write_queue,), daemon=True)
+    writer.start()
 
-        # Display the current frame in a window
-        cv2.imshow('Camera Feed', frame)
+    if PREVIEW:
+        print("Press 'p' to capture an image, or 'q' to quit.")
+    else:
+        # No window means no cv2.waitKey input; read commands from stdin
+        command_queue = queue.Queue()
+        threading.Thread(target=command_reader, args=(command_queue,), daemon=True).start()
+        print("Type 'p' + Enter to capture an image, or 'q' + Enter to quit.")
 
-        # Wait for key press
-        key = cv2.waitKey(1) & 0xFF
+    try:
+        while True:
+            # grab() alone keeps the driver's frame ring moving; the color
+            # conversion in retrieve() only runs when the frame will be seen
+            if not cap.grab():
+                print("Failed to grab frame. Exiting...")
+                break
 
-        if key == ord('p'):
-            # Generate a filename with the current timestamp
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = os.path.join(output_folder, f"capture_{timestamp}.png")
+            frame = None
+            if PREVIEW:
+                ret, frame = cap.retrieve(frame_buf)
+                if ret:
+                    # Display the current frame in a window
+                    cv2.imshow('Camera Feed', frame)
+                # Wait for key press
+                key = cv2.waitKey(1) & 0xFF
+            else:
+                try:
+                    command = command_queue.get_nowait()
+                except queue.Empty:
+                    command = ""
+                key = ord(command[0]) if command else 0xFF
 
-            # Save the captured image
-            cv2.imwrite(filename, frame)
-            print(f"Image saved as: {filename}")
-        elif key == ord('q'):
-            # Exit the loop when 'q' is pressed
-            print("Exiting...")
-            break
+            if key == ord('p'):
+                if frame is None:
+                    # Preview is off, so decode just this captured frame
+                    ret, frame = cap.retrieve(frame_buf)
+                    if not ret:
+                        print("Failed to retrieve frame for capture.")
+                        continue
+                # Nanosecond timestamp: unique even for captures within the
+                # same second, with no strftime formatting on the hot path
+                filename = os.path.join(output_folder, f"capture_{time.time_ns()}.jpg")
 
-    # Release the camera and close any open windows
-    cap.release()
-    cv2.destroyAllWindows()
+                # Hand a copy to the writer thread (the shared buffer is
+                # reused by the very next retrieve)
+                try:
+                    write_queue.put_nowait((filename, frame.copy()))
+                except queue.Full:
+                    print("Warning: writer is backed up, capture dropped.")
+            elif key == ord('q'):
+                # Exit the loop when 'q' is pressed
+                print("Exiting...")
+                break
+    finally:
+        # Flush any pending writes, then release the camera and close
+        # windows, even when the loop ends via Ctrl-C
+        write_queue.put(None)
+        writer.join()
+        cap.release()
+        cv2.destroyAllWindows()
 
 if __name__ == '__main__':
     main()